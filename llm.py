@@ -1,10 +1,19 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langchain_core.caches import BaseCache
+from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+from langchain.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 from pydantic import BaseModel, Field
+import asyncio
+import logging
+import numpy as np
 import os
 from dotenv import load_dotenv
 
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 # Cargar variables de entorno desde .env
 load_dotenv()
 
@@ -27,57 +36,167 @@ class TaskList(BaseModel):
 # Asegúrate de tener tu API key de Google configurada como variable de entorno
 # GOOGLE_API_KEY debe estar definida como variable de entorno
 
+# Umbral de similitud coseno para considerar dos prompts equivalentes
+SIMILARITY_THRESHOLD = 0.92
+
+
+class SemanticCache(BaseCache):
+    """Cache en dos niveles: hit exacto vía SQLite y hit semántico vía embeddings.
+
+    Paráfrasis del mismo texto ("comprar leche y mandar informe" vs
+    "compra leche y envía el informe") fallan el cache byte a byte pero
+    comparten respuesta si la similitud coseno de sus embeddings supera
+    el umbral, evitando la llamada al LLM.
+    """
+
+    def __init__(self, exact_cache, embeddings, threshold=SIMILARITY_THRESHOLD):
+        self.exact_cache = exact_cache
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self._vectors = []  # embeddings normalizados de los prompts ya vistos
+        self._entries = []  # (llm_string, return_val) asociado a cada vector
+        self._pending_vectors = {}  # embeddings calculados en lookup, a la espera del update
+
+    def lookup(self, prompt, llm_string):
+        # Primer nivel: hit exacto (SELECT en SQLite, sin costo de embedding)
+        hit = self.exact_cache.lookup(prompt, llm_string)
+        if hit is not None:
+            return hit
+        if not self._vectors:
+            return None
+        # Segundo nivel: vecino más cercano por similitud coseno
+        vec = self._embed(prompt)
+        sims = np.array(self._vectors) @ vec
+        best = int(np.argmax(sims))
+        if sims[best] >= self.threshold and self._entries[best][0] == llm_string:
+            return self._entries[best][1]
+        # Miss: guardar el embedding para que update() lo reutilice en vez de
+        # pagar un segundo round-trip de embedding por el mismo prompt
+        self._pending_vectors[prompt] = vec
+        return None
+
+    def update(self, prompt, llm_string, return_val):
+        self.exact_cache.update(prompt, llm_string, return_val)
+        vec = self._pending_vectors.pop(prompt, None)
+        if vec is None:
+            vec = self._embed(prompt)
+        self._vectors.append(vec)
+        self._entries.append((llm_string, return_val))
+
+    def clear(self, **kwargs):
+        self.exact_cache.clear(**kwargs)
+        self._vectors.clear()
+        self._entries.clear()
+        self._pending_vectors.clear()
+
+    def _embed(self, prompt):
+        vec = np.array(self.embeddings.embed_query(prompt))
+        return vec / np.linalg.norm(vec)
+
+
+# Cache local de respuestas: prompts idénticos no vuelven a llamar a Gemini
+# (hit exacto en SQLite) y las paráfrasis se resuelven por similitud semántica
+set_llm_cache(
+    SemanticCache(
+        exact_cache=SQLiteCache(database_path=".langchain.db"),
+        embeddings=GoogleGenerativeAIEmbeddings(model="models/embedding-001"),
+    )
+)
+
 model = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0)
-prompt = ChatPromptTemplate.from_template("""
-Extrae todas las tareas del siguiente texto y devuélvelas en formato JSON.
-Para cada tarea, determina su prioridad basándote en el contexto:
-- Alta: tareas urgentes, con tiempo límite específico o muy importantes
-- Media: tareas importantes pero sin urgencia inmediata
-- Baja: tareas rutinarias o de menor importancia
-
-Texto: {text}
-
-Devuelve el resultado en este formato JSON:
-{{
-    "tasks": [
-        {{"action": "descripción de la tarea", "priority": "Alta/Media/Baja"}},
-        ...
-    ]
-}}
-""")
 
-# 3. Crear la cadena chain
+# Todas las instrucciones estáticas van primero y en un solo bloque constante:
+# los proveedores cachean prefijos repetidos del prompt, así que mantener este
+# texto byte a byte idéntico entre llamadas maximiza los hits de prefix-cache
+# y deja solo {text} como parte variable al final. El esquema JSON ya no va en
+# el prompt: Gemini lo recibe como schema nativo vía with_structured_output
+STATIC_INSTRUCTIONS = (
+    "Extrae las tareas del texto del usuario. Prioridad según contexto: "
+    "Alta (urgente o con plazo), Media (importante sin urgencia), Baja (rutinaria)."
+)
 
-chain = prompt | model | JsonOutputParser(pydantic_object=TaskList)
+# El mensaje de sistema se construye una sola vez; por llamada solo se crea el
+# HumanMessage con el texto, sin pasar por el render de ChatPromptTemplate
+SYSTEM_MSG = SystemMessage(content=STATIC_INSTRUCTIONS)
 
-# 4. Ejecutar con LangSmith tracking
-texto_ejemplo = "Hola, recuerda comprar leche y enviar el informe antes de las 5pm. También necesito llamar al cliente para confirmar la reunión de mañana y revisar los emails."
-
-# Ejecutar con metadatos para LangSmith
-resultado = chain.invoke(
-    {"text": texto_ejemplo},
-    config={
-        "metadata": {
-            "user_id": "usuario_test",
-            "session_id": "session_001",
-            "task_type": "extraccion_tareas"
-        },
-        "tags": ["task_extraction", "gemini", "json_parser"]
-    }
+
+def _build_messages(inputs):
+    """Arma la lista de mensajes para una entrada {"text": ...}."""
+    return [SYSTEM_MSG, HumanMessage(content=inputs["text"])]
+
+# 3. Crear la cadena chain
+# with_structured_output usa el modo JSON nativo de Gemini: la respuesta llega
+# ya validada como TaskList, sin parseo de texto ni reintentos por JSON malformado
+
+
+def _log_usage(result):
+    """Registra los tokens consumidos por la llamada y devuelve el TaskList.
+
+    Estos números son la señal para decidir qué prompts recortar o cachear:
+    cache_read > 0 confirma que el prefix-cache del proveedor está funcionando.
+    """
+    usage = getattr(result["raw"], "usage_metadata", None) or {}
+    logger.info(
+        "uso de tokens: input=%s output=%s cache_read=%s",
+        usage.get("input_tokens"),
+        usage.get("output_tokens"),
+        usage.get("input_token_details", {}).get("cache_read", 0),
+    )
+    return result["parsed"]
+
+
+chain = (
+    RunnableLambda(_build_messages)
+    | model.with_structured_output(TaskList, include_raw=True)
+    | RunnableLambda(_log_usage)
 )
 
+# 4. Ejecutar con LangSmith tracking
+# Límite de llamadas simultáneas a Gemini (para no agotar la cuota)
+MAX_CONCURRENCY = 16
+
+
+async def run(texts):
+    """Procesa varios textos en paralelo con abatch.
+
+    Las llamadas a Gemini se solapan en vez de serializarse, así el tiempo
+    total escala con ceil(N / MAX_CONCURRENCY) round-trips en lugar de N.
+    """
+    return await chain.abatch(
+        [{"text": t} for t in texts],
+        config={
+            "max_concurrency": MAX_CONCURRENCY,
+            "metadata": {
+                "user_id": "usuario_test",
+                "session_id": "session_001",
+                "task_type": "extraccion_tareas"
+            },
+            "tags": ["task_extraction", "gemini", "structured_output"]
+        }
+    )
+
+
+textos_ejemplo = [
+    "Hola, recuerda comprar leche y enviar el informe antes de las 5pm. También necesito llamar al cliente para confirmar la reunión de mañana y revisar los emails.",
+    "Compra leche y envía el informe, por favor. No te olvides de regar las plantas.",
+]
+
+# Ejecutar el lote con metadatos para LangSmith
+resultados = asyncio.run(run(textos_ejemplo))
+
 print("=== TAREAS EXTRAÍDAS ===")
-print(f"Texto analizado: {texto_ejemplo[:50]}...")
-print()
-
-if isinstance(resultado, dict) and 'tasks' in resultado:
-    print(f"Se encontraron {len(resultado['tasks'])} tareas:")
-    for i, task in enumerate(resultado['tasks'], 1):
-        print(f"{i}. Tarea: {task['action']}")
-        print(f"   Prioridad: {task['priority']}")
-        print()
-else:
-    print("Resultado completo:", resultado)
+for texto_ejemplo, resultado in zip(textos_ejemplo, resultados):
+    print(f"Texto analizado: {texto_ejemplo[:50]}...")
+    print()
+
+    if isinstance(resultado, TaskList):
+        print(f"Se encontraron {len(resultado.tasks)} tareas:")
+        for i, task in enumerate(resultado.tasks, 1):
+            print(f"{i}. Tarea: {task.action}")
+            print(f"   Prioridad: {task.priority}")
+            print()
+    else:
+        print("Resultado completo:", resultado)
 
 print("✅ Ejecución completada. Revisa LangSmith para ver el tracing en:")
 print("https://smith.langchain.com")
\ No newline at end of file
@@ -7,21 +7,38 @@ Este ejercicio crea un agente conversacional que:
 3. Es observado por LangSmith para trazabilidad
 """
 
+import asyncio
+import functools
+import logging
 import os
+import time
 from dotenv import load_dotenv
-from typing import TypedDict, Annotated, Sequence
-from operator import add
+from typing import TypedDict, Annotated, Sequence, Final
+
+# Reintentos ante límites de cuota de Gemini
+from google.api_core.exceptions import ResourceExhausted
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 # LangChain y LangGraph
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+import aiosqlite
 
 # Telegram
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
+# Webhook (Telegram empuja los updates en vez de long-polling)
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response
+import orjson
+import uvicorn
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -36,9 +53,22 @@ os.environ["LANGCHAIN_PROJECT"] = "telegram-agent-langgraph"
 # ==========================================
 # DEFINICIÓN DEL ESTADO DEL AGENTE
 # ==========================================
+
+# Máximo de turnos (par humano/IA) que se conservan en el historial. Sin este
+# tope cada turno re-envía la conversación completa a Gemini y el costo en
+# tokens crece cuadráticamente con la longitud de la charla
+MAX_TURNS = 10
+
+
+def add_capped(old: Sequence[BaseMessage], new: Sequence[BaseMessage]) -> list[BaseMessage]:
+    """Reducer que acumula mensajes pero recorta a los últimos MAX_TURNS pares."""
+    out = list(old) + list(new)
+    return out[-MAX_TURNS * 2:]
+
+
 class AgentState(TypedDict):
     """Estado del agente que mantiene el historial de mensajes"""
-    messages: Annotated[Sequence[BaseMessage], add]
+    messages: Annotated[Sequence[BaseMessage], add_capped]
     user_id: str
 
 # ==========================================
@@ -50,21 +80,20 @@ llm = ChatGoogleGenerativeAI(
     max_tokens=1024
 )
 
+# Máximo de llamadas al LLM en vuelo: por encima de este límite las peticiones
+# esperan su turno en vez de tropezar en masa con la cuota de Gemini
+LLM_SEM = asyncio.Semaphore(int(os.getenv("MAX_INFLIGHT_LLM", "8")))
+
 # ==========================================
 # NODOS DEL GRAFO
 # ==========================================
 
-def process_message(state: AgentState) -> dict:
-    """
-    Nodo principal que procesa el mensaje del usuario.
-    Añade contexto del sistema y genera la respuesta.
-    """
-    messages = state["messages"]
-    
-    # Mensaje del sistema con instrucciones para el agente
-    system_message = SystemMessage(content="""
+# Mensaje del sistema con instrucciones para el agente. Es una constante de
+# módulo: se construye una sola vez y llega byte a byte idéntico en cada
+# llamada, que es justo lo que el prefix-cache del proveedor puede reutilizar
+SYSTEM_MESSAGE = SystemMessage(content="""
     Eres un asistente virtual inteligente y amigable que responde consultas por Telegram.
-    
+
     Instrucciones:
     - Responde de manera clara, concisa y útil
     - Usa emojis ocasionalmente para hacer la conversación más amigable
@@ -72,13 +101,29 @@ def process_message(state: AgentState) -> dict:
     - Puedes responder en español o inglés según el idioma del usuario
     - Mantén un tono profesional pero cercano
     """)
-    
-    # Construir la lista de mensajes para el LLM
-    full_messages = [system_message] + list(messages)
-    
-    # Invocar el modelo
-    response = llm.invoke(full_messages)
-    
+
+
+async def process_message(state: AgentState) -> dict:
+    """
+    Nodo principal que procesa el mensaje del usuario.
+    Antepone el contexto del sistema y genera la respuesta.
+    """
+    messages = state["messages"]
+
+    # Invocar el modelo (la tupla evita copiar el historial a una lista nueva)
+    response = await llm.ainvoke((SYSTEM_MESSAGE, *messages))
+
+    # Registrar consumo de tokens: es la señal para decidir qué recortar o
+    # cachear, y cache_read > 0 confirma hits del prefix-cache del proveedor
+    usage = getattr(response, "usage_metadata", None) or {}
+    logger.info(
+        "uso de tokens [user=%s]: input=%s output=%s cache_read=%s",
+        state.get("user_id"),
+        usage.get("input_tokens"),
+        usage.get("output_tokens"),
+        usage.get("input_token_details", {}).get("cache_read", 0),
+    )
+
     return {"messages": [response]}
 
 
@@ -93,37 +138,53 @@ def should_continue(state: AgentState) -> str:
 # CONSTRUCCIÓN DEL GRAFO CON LANGGRAPH
 # ==========================================
 
-def create_agent_graph():
-    """Crea y compila el grafo del agente."""
-    
+def create_agent_graph(checkpointer):
+    """Crea y compila el grafo del agente con el checkpointer recibido."""
+
     # Crear el grafo de estados
     workflow = StateGraph(AgentState)
-    
+
     # Añadir nodos
     workflow.add_node("process", process_message)
-    
+
     # Definir el punto de entrada
     workflow.set_entry_point("process")
-    
+
     # Añadir aristas
     workflow.add_edge("process", END)
-    
-    # Compilar con memoria para mantener el historial por usuario
-    memory = MemorySaver()
-    graph = workflow.compile(checkpointer=memory)
-    
+
+    # Compilar con el checkpointer inyectado
+    graph = workflow.compile(checkpointer=checkpointer)
+
     return graph
 
+
+@functools.lru_cache(maxsize=1)
+def get_agent():
+    """Devuelve el grafo compilado, construyéndolo una sola vez por proceso.
+
+    Con gunicorn --preload la compilación ocurre antes del fork y los
+    workers comparten el grafo por copy-on-write; el estado vive en SQLite,
+    no en el grafo, así que compartirlo es seguro.
+    """
+    # Memoria persistente en SQLite: el historial por usuario sobrevive
+    # reinicios y no se acumula en el heap del proceso. La variante async es
+    # obligatoria porque el grafo se invoca con ainvoke (la versión síncrona
+    # lanza NotImplementedError en aget_tuple/aput)
+    memory = AsyncSqliteSaver(aiosqlite.connect("checkpoints.db"))
+    return create_agent_graph(memory)
+
+
 # Crear la instancia del agente
-agent = create_agent_graph()
+agent = get_agent()
 
 # ==========================================
 # HANDLERS DE TELEGRAM
 # ==========================================
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Comando /start - Mensaje de bienvenida"""
-    welcome_message = """
+# Textos de los comandos, construidos una sola vez: /start y /help son los
+# handlers más llamados y no tienen nada variable por usuario
+WELCOME_MESSAGE: Final = """
 👋 ¡Hola! Soy un agente inteligente powered by LangGraph y Gemini.
 
 Puedo ayudarte con:
@@ -138,19 +199,8 @@ Comandos disponibles:
 /clear - Limpiar el historial de conversación
 /help - Obtener ayuda
     """
-    await update.message.reply_text(welcome_message)
 
-
-async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Comando /clear - Limpia el historial de conversación"""
-    user_id = str(update.effective_user.id)
-    context.user_data.clear()
-    await update.message.reply_text("🗑️ Historial de conversación limpiado. ¡Empecemos de nuevo!")
-
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Comando /help - Muestra ayuda"""
-    help_text = """
+HELP_TEXT: Final = """
 📚 **Guía de uso**
 
 Este bot utiliza LangGraph para mantener conversaciones inteligentes.
@@ -165,23 +215,99 @@ Este bot utiliza LangGraph para mantener conversaciones inteligentes.
 - Usa /clear si quieres empezar una conversación nueva
 - El bot recuerda el contexto de la conversación
     """
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /start - Mensaje de bienvenida"""
+    await update.message.reply_text(WELCOME_MESSAGE)
+
+
+async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /clear - Limpia el historial de conversación"""
+    user_id = str(update.effective_user.id)
+    context.user_data.clear()
+    await update.message.reply_text("🗑️ Historial de conversación limpiado. ¡Empecemos de nuevo!")
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /help - Muestra ayuda"""
+    await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
+
+
+# Ventana de debounce: mensajes del mismo usuario que lleguen dentro de esta
+# ventana se agrupan en una sola llamada al LLM (N mensajes -> 1 generación)
+DEBOUNCE_SECS = 3
+
+# Buffer de textos pendientes y timer activo por usuario
+_pending_messages: dict[str, list[str]] = {}
+_debounce_tasks: dict[str, asyncio.Task] = {}
+
+# Respuesta fija ante errores: el texto de la excepción nunca se reenvía al
+# chat (filtra internals y, en fallas en cascada, alimenta espirales de flood)
+ERROR_REPLY: Final = "❌ Tuve un problema procesando tu mensaje. Intenta de nuevo."
+
+# Breaker por usuario: superado este ritmo de errores dejamos de responder
+# para cortar el bucle error -> reply -> error
+MAX_ERRORS = 5
+ERROR_WINDOW_SECS = 60
+_error_times: dict[str, list[float]] = {}
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Maneja los mensajes de texto del usuario.
-    Invoca el agente LangGraph y devuelve la respuesta.
+    Acumula los mensajes de una ráfaga y reinicia el timer de debounce;
+    el lote completo se procesa en una sola invocación del agente.
     """
     user_id = str(update.effective_user.id)
-    user_message = update.message.text
-    
-    # Mostrar indicador de escritura
-    await context.bot.send_chat_action(
+
+    _pending_messages.setdefault(user_id, []).append(update.message.text)
+
+    # Reiniciar el timer: cada mensaje nuevo extiende la ventana
+    previous_task = _debounce_tasks.get(user_id)
+    if previous_task is not None:
+        previous_task.cancel()
+    _debounce_tasks[user_id] = asyncio.create_task(
+        _flush_after_debounce(update, context, user_id)
+    )
+
+
+async def _flush_after_debounce(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str):
+    """Espera la ventana de debounce y procesa el lote acumulado del usuario."""
+    await asyncio.sleep(DEBOUNCE_SECS)
+
+    # Si un mensaje nuevo llegó en esta misma iteración del loop, este timer
+    # ya fue reemplazado: el buffer le pertenece al timer nuevo y drenarlo
+    # aquí perdería la ráfaga completa sin respuesta ni log
+    if _debounce_tasks.get(user_id) is not asyncio.current_task():
+        return
+
+    _debounce_tasks.pop(user_id, None)
+    texts = _pending_messages.pop(user_id, [])
+    if not texts:
+        return
+    try:
+        await _process_user_message(update, context, user_id, "\n".join(texts))
+    except asyncio.CancelledError:
+        # Cancelado con el lote ya drenado: devolverlo al frente del buffer
+        # para que lo procese el timer de reemplazo en vez de perderlo
+        _pending_messages[user_id] = texts + _pending_messages.get(user_id, [])
+        raise
+
+
+async def _process_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                user_id: str, user_message: str):
+    """
+    Invoca el agente LangGraph con el texto (ya coalescido) del usuario
+    y devuelve la respuesta.
+    """
+    # Mostrar indicador de escritura sin esperarlo: se emite en paralelo con
+    # la llamada al LLM en vez de sumar un round-trip a Telegram antes de ella
+    asyncio.create_task(context.bot.send_chat_action(
         chat_id=update.effective_chat.id,
         action="typing"
-    )
-    
+    ))
+
     try:
         # Configuración del thread para mantener memoria por usuario
         config = {"configurable": {"thread_id": user_id}}
@@ -192,8 +318,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "user_id": user_id
         }
         
-        # Invocar el agente
-        result = agent.invoke(input_state, config=config)
+        # Invocar el agente sin bloquear el event loop: mientras Gemini
+        # responde, el bot sigue atendiendo updates de otros usuarios.
+        # El semáforo acota el paralelismo y tenacity reintenta con backoff
+        # exponencial + jitter si Gemini devuelve agotamiento de cuota
+        async with LLM_SEM:
+            async for attempt in AsyncRetrying(
+                wait=wait_exponential_jitter(initial=1, max=30),
+                stop=stop_after_attempt(4),
+                retry=retry_if_exception_type((ResourceExhausted, TimeoutError)),
+                reraise=True,
+            ):
+                with attempt:
+                    result = await agent.ainvoke(input_state, config=config)
         
         # Obtener la última respuesta del agente
         ai_response = result["messages"][-1].content
@@ -201,15 +338,66 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Enviar respuesta al usuario
         await update.message.reply_text(ai_response)
         
-    except Exception as e:
-        error_message = f"❌ Ocurrió un error: {str(e)}"
-        print(f"Error procesando mensaje: {e}")
-        await update.message.reply_text(error_message)
+    except Exception:
+        # Traceback completo al log local; al usuario solo el mensaje fijo
+        logger.exception("agent_invoke_failed", extra={"user_id": user_id})
+
+        now = time.monotonic()
+        recent = [t for t in _error_times.get(user_id, []) if now - t < ERROR_WINDOW_SECS]
+        recent.append(now)
+        _error_times[user_id] = recent
+        if len(recent) <= MAX_ERRORS:
+            await update.message.reply_text(ERROR_REPLY)
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja errores globales del bot"""
-    print(f"Error: {context.error}")
+    logger.error("error global del bot", exc_info=context.error)
+
+
+# ==========================================
+# WEBHOOK (FASTAPI)
+# ==========================================
+# URL pública donde Telegram enviará los updates (ej. https://mi-dominio.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = "/webhook"
+# Token secreto que Telegram devuelve en cada push para autenticar el origen
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+
+def create_webhook_app(application: Application) -> FastAPI:
+    """Crea la app FastAPI que recibe los updates empujados por Telegram."""
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Arrancar la aplicación de Telegram y registrar el webhook
+        await application.initialize()
+        await application.start()
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            # Solo mensajes: el bot no maneja edits, callbacks ni eventos de
+            # chat, así que pedirlos sería puro tráfico y parseo desperdiciado
+            allowed_updates=["message"],
+            secret_token=WEBHOOK_SECRET,
+        )
+        yield
+        await application.stop()
+        await application.shutdown()
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.post(WEBHOOK_PATH)
+    async def telegram_webhook(request: Request) -> Response:
+        # Verificar que el push viene realmente de Telegram
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return Response(status_code=403)
+        # orjson (C + SIMD) parsea el payload bastante más rápido que el
+        # json.loads de stdlib que usaría request.json()
+        update = Update.de_json(orjson.loads(await request.body()), application.bot)
+        await application.process_update(update)
+        return Response(status_code=200)
+
+    return app
 
 
 # ==========================================
@@ -218,35 +406,46 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 def main():
     """Inicializa y ejecuta el bot de Telegram."""
-    
+
     # Obtener el token del bot
     telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
-    
+
     if not telegram_token:
         print("❌ Error: TELEGRAM_BOT_TOKEN no está configurado en el archivo .env")
         print("Por favor, añade tu token de Telegram al archivo .env:")
         print("TELEGRAM_BOT_TOKEN=tu_token_aquí")
         return
-    
+
     print("🚀 Iniciando bot de Telegram con LangGraph...")
     print("📊 LangSmith está configurado para observabilidad")
     print("🧠 Usando Gemini 2.5-flash como modelo")
-    
+
     # Crear la aplicación
     application = Application.builder().token(telegram_token).build()
-    
+
     # Añadir handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("clear", clear_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    
+
     # Handler de errores
     application.add_error_handler(error_handler)
-    
+
     # Ejecutar el bot
-    print("✅ Bot iniciado. Presiona Ctrl+C para detener.")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # Modo webhook: Telegram empuja cada update apenas llega, sin la
+        # latencia ni el socket permanente del long-polling
+        print(f"✅ Bot iniciado en modo webhook: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        uvicorn.run(
+            create_webhook_app(application),
+            host="0.0.0.0",
+            port=int(os.getenv("PORT", "8000")),
+        )
+    else:
+        # Fallback para desarrollo local sin URL pública
+        print("✅ Bot iniciado en modo polling. Presiona Ctrl+C para detener.")
+        application.run_polling(allowed_updates=["message"])
 
 
 if __name__ == "__main__":